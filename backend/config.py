@@ -8,6 +8,18 @@ from datetime import timedelta
 SURGE_ID_TTL = timedelta(hours=1)
 
 
+# ZONE SETTINGS
+# the zones a passenger can scan into, congestion is reported for each of them
+VALID_ZONES: frozenset[str] = frozenset({
+    "terminal_entry",
+    "security",
+    "customs",
+    "boarding_gate",
+    "transfer",
+    "amenities"
+})
+
+
 # QR CODE SETTINGS
 QR_IMG_SIZE = 300
 QR_IMAGE_FORMAT = "png"
@@ -1,11 +1,12 @@
 # Congestion Heatmap Logic
 # Computes zone-level congestion without exposing personal SURGE IDs
 
-from datetime import datetime, timedelta
-from collections import defaultdict
-import json
+from datetime import datetime, timezone
+import time
 from enum import Enum
 
+from config import VALID_ZONES
+
 
 class CongestionLevel(str, Enum):
     LOW = "LOW"
@@ -20,122 +21,88 @@ CONGESTION_THRESHOLDS = {
     "medium_max": 300    # scores below this are MEDIUM, above is HIGH
 }
 
-# Rolling window for scan rate calculation
+# Rolling window for scan rate and dwell time calculation
 SCAN_RATE_WINDOW_MINUTES = 5
 
-
-def get_all_surge_ids(redis_client) -> list[str]:
-    """
-    Get all active SURGE IDs from Redis.
-    Active IDs are stored as surge:{id} keys.
-    """
-    surge_ids = []
-    # Scan for all surge:* keys that don't have :scans suffix
-    cursor = 0
-    while True:
-        cursor, keys = redis_client.scan(cursor, match="surge:*", count=100)
-        for key in keys:
-            # Filter out scan lists, only get base surge IDs
-            if ":scans" not in key:
-                # Extract the ID from surge:{id}
-                surge_id = key.replace("surge:", "")
-                surge_ids.append(surge_id)
-        if cursor == 0:
-            break
-    return surge_ids
-
-
-def get_scans_for_surge_id(redis_client, surge_id: str) -> list[dict]:
-    """
-    Get all scan events for a specific SURGE ID.
-    Returns list of {zone, timestamp} dicts sorted by timestamp.
-    """
-    scans_key = f"surge:{surge_id}:scans"
-    raw_scans = redis_client.lrange(scans_key, 0, -1)
-
-    scans = []
-    for raw in raw_scans:
-        try:
-            scan = json.loads(raw)
-            # Parse the ISO timestamp
-            scan["timestamp"] = datetime.fromisoformat(scan["timestamp"])
-            scans.append(scan)
-        except (json.JSONDecodeError, KeyError, ValueError):
-            continue
-
-    # Sort by timestamp
-    scans.sort(key=lambda x: x["timestamp"])
-    return scans
-
-
-def compute_dwell_times(scans: list[dict]) -> dict[str, list[float]]:
-    """
-    Compute dwell times for each zone based on consecutive scans.
-    Dwell time = time spent in a zone before moving to the next.
-
-    For each consecutive scan pair:
-        dwell = next_time - current_time
-        Assign dwell to the zone of the current scan
-
-    Returns dict mapping zone -> list of dwell times in seconds
-    """
-    dwell_times = defaultdict(list)
-
-    for i in range(len(scans) - 1):
-        current_scan = scans[i]
-        next_scan = scans[i + 1]
-
-        current_zone = current_scan["zone"]
-        current_time = current_scan["timestamp"]
-        next_time = next_scan["timestamp"]
-
-        # Calculate dwell time in seconds
-        dwell = (next_time - current_time).total_seconds()
-
-        # Only count positive, reasonable dwell times (< 2 hours)
-        if 0 < dwell < 7200:
-            dwell_times[current_zone].append(dwell)
-
-    return dict(dwell_times)
-
-
-def aggregate_dwell_by_zone(all_dwell_times: list[dict[str, list[float]]]) -> dict[str, float]:
-    """
-    Aggregate all dwell times across all SURGE IDs and compute average per zone.
-    Returns dict mapping zone -> average dwell time in seconds
-    """
-    zone_dwells = defaultdict(list)
-
-    for dwell_dict in all_dwell_times:
-        for zone, times in dwell_dict.items():
-            zone_dwells[zone].extend(times)
-
-    # Compute averages
-    avg_dwells = {}
-    for zone, times in zone_dwells.items():
-        if times:
-            avg_dwells[zone] = sum(times) / len(times)
-        else:
-            avg_dwells[zone] = 0.0
-
-    return avg_dwells
-
-
-def compute_scan_rate(redis_client, surge_ids: list[str], window_minutes: int = SCAN_RATE_WINDOW_MINUTES) -> dict[str, int]:
-    """
-    Count scans per zone within the rolling time window.
-    Returns dict mapping zone -> scan count
-    """
-    cutoff_time = datetime.utcnow() - timedelta(minutes=window_minutes)
-    zone_counts = defaultdict(int)
-
-    for surge_id in surge_ids:
-        scans = get_scans_for_surge_id(redis_client, surge_id)
-        for scan in scans:
-            if scan["timestamp"] >= cutoff_time:
-                zone_counts[scan["zone"]] += 1
-
-    return dict(zone_counts)
+# Dwell sums/counts are kept in buckets of this size so old ones can expire
+DWELL_BUCKET_SECONDS = 60
+
+
+# Dwell times at or above this are treated as abandoned IDs, not real dwell
+MAX_DWELL_SECONDS = 7200
+
+
+# Applies one /scan atomically, so two overlapping scans of the same SURGE ID
+# can't both read the same previous zone and count its dwell twice.
+#   KEYS[1] = surge:{id}, KEYS[2] = surge:{id}:zone
+#   ARGV    = surge_id, zone, ts, window_seconds, bucket_seconds, max_dwell_seconds
+# Returns {"missing"}, {"already_scanned", ts_entered} or {"recorded"}.
+APPLY_SCAN_LUA = """
+local ttl = redis.call('PTTL', KEYS[1])
+if ttl == -2 then
+    return {'missing'}
+end
+
+local prev = redis.call('HMGET', KEYS[2], 'zone', 'ts')
+if prev[1] == ARGV[2] then
+    return {'already_scanned', prev[2]}
+end
+
+local ts = tonumber(ARGV[3])
+local window = tonumber(ARGV[4])
+local bucket_seconds = tonumber(ARGV[5])
+
+-- the current zone expires together with the surge id
+redis.call('HSET', KEYS[2], 'zone', ARGV[2], 'ts', ARGV[3])
+if ttl > 0 then
+    redis.call('PEXPIRE', KEYS[2], ttl)
+end
+
+-- fold the dwell in the zone being left into the current minute bucket
+if prev[1] and prev[2] then
+    local dwell = ts - tonumber(prev[2])
+    if dwell > 0 and dwell < tonumber(ARGV[6]) then
+        local stats_key = 'zone_stats:' .. prev[1] .. ':' .. math.floor(ts / bucket_seconds)
+        redis.call('HINCRBYFLOAT', stats_key, 'dwell_sum', dwell)
+        redis.call('HINCRBY', stats_key, 'dwell_count', 1)
+        -- keep the bucket until the whole of it is older than the window
+        redis.call('EXPIRE', stats_key, window + bucket_seconds)
+    end
+end
+
+-- index the scan for the scan rate window, trimming what has fallen out of it
+local scans_key = 'zone:' .. ARGV[2] .. ':scans'
+redis.call('ZADD', scans_key, ts, ARGV[1])
+redis.call('ZREMRANGEBYSCORE', scans_key, '-inf', ts - window)
+redis.call('EXPIRE', scans_key, window)
+return {'recorded'}
+"""
+
+
+def apply_scan(redis_client, surge_id: str, zone: str, ts: float) -> tuple[str, float | None]:
+    """
+    Record a scan of surge_id into zone at ts and update the zone aggregates.
+
+    The current zone lives in surge:{id}:zone. On a zone change the dwell in
+    the zone being left is added to its minute bucket, zone_stats:{zone}:{minute},
+    and the scan is indexed under zone:{zone}:scans for the scan rate window.
+    All of it runs in one Lua script so it happens at most once per zone change.
+
+    Returns (status, entered_at) where status is "missing", "already_scanned"
+    or "recorded", and entered_at is when the passenger entered the zone they
+    were already in (only for "already_scanned").
+    """
+    # register_script runs EVALSHA and falls back to EVAL if Redis lost the script
+    script = redis_client.register_script(APPLY_SCAN_LUA)
+    reply = script(
+        keys=[f"surge:{surge_id}", f"surge:{surge_id}:zone"],
+        args=[surge_id, zone, ts, SCAN_RATE_WINDOW_MINUTES * 60,
+              DWELL_BUCKET_SECONDS, MAX_DWELL_SECONDS],
+    )
+
+    status = reply[0]
+    entered_at = reply[1] if len(reply) > 1 else None
+    return status, float(entered_at) if entered_at is not None else None
 
 
 def calculate_congestion_score(scan_rate: int, avg_dwell_time: float) -> float:
@@ -178,35 +145,31 @@ def get_zone_congestion(redis_client) -> dict:
         "computed_at": "ISO timestamp"
     }
     """
-    # Get all active SURGE IDs
-    surge_ids = get_all_surge_ids(redis_client)
-
-    # Collect dwell times from all SURGE IDs
-    all_dwell_times = []
-    for surge_id in surge_ids:
-        scans = get_scans_for_surge_id(redis_client, surge_id)
-        if scans:
-            dwell_times = compute_dwell_times(scans)
-            all_dwell_times.append(dwell_times)
-
-    # Aggregate dwell times by zone
-    avg_dwell_by_zone = aggregate_dwell_by_zone(all_dwell_times)
-
-    # Compute scan rates per zone
-    scan_rates = compute_scan_rate(redis_client, surge_ids)
-
-    # Get all known zones
-    all_zones = set(avg_dwell_by_zone.keys()) | set(scan_rates.keys())
-
-    # If no data, include all valid zones with zero values
-    from main import VALID_ZONES
-    all_zones = all_zones | VALID_ZONES
-
-    # Build zone congestion data
+    # Everything is aggregated on write, so this is one pipelined pass over the zones
+    zones = list(VALID_ZONES)
+    # one clock read drives both the window cutoff and computed_at
+    now = time.time()
+    cutoff = now - SCAN_RATE_WINDOW_MINUTES * 60
+
+    # every dwell bucket that overlaps the window (the oldest one only partly)
+    buckets = range(int(cutoff // DWELL_BUCKET_SECONDS),
+                    int(now // DWELL_BUCKET_SECONDS) + 1)
+
+    pipe = redis_client.pipeline(transaction=False)
+    for zone in zones:
+        for bucket in buckets:
+            pipe.hmget(f"zone_stats:{zone}:{bucket}", "dwell_sum", "dwell_count")
+        pipe.zcount(f"zone:{zone}:scans", cutoff, "+inf")
+    results = pipe.execute()
+
+    # Build zone congestion data, zones with no data come out as zero
+    per_zone = len(buckets) + 1
     zones_data = {}
-    for zone in all_zones:
-        avg_dwell = avg_dwell_by_zone.get(zone, 0.0)
-        scan_count = scan_rates.get(zone, 0)
+    for i, zone in enumerate(zones):
+        *dwell_buckets, scan_count = results[i * per_zone:(i + 1) * per_zone]
+        dwell_sum = sum(float(total) for total, _ in dwell_buckets if total)
+        dwell_count = sum(int(count) for _, count in dwell_buckets if count)
+        avg_dwell = dwell_sum / dwell_count if dwell_count else 0.0
 
         score = calculate_congestion_score(scan_count, avg_dwell)
         level = classify_congestion(score)
@@ -220,6 +183,8 @@ def get_zone_congestion(redis_client) -> dict:
 
     return {
         "zones": zones_data,
-        "computed_at": datetime.utcnow().isoformat(),
+        # only turned into a datetime here, FastAPI's jsonable_encoder
+        # converts it with isoformat() before the response is written
+        "computed_at": datetime.fromtimestamp(now, timezone.utc),
         "window_minutes": SCAN_RATE_WINDOW_MINUTES
     }
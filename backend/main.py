@@ -1,17 +1,21 @@
 # Surge Main.py
 # this creates the web server
 # fastapi will handle the routing + HTTP requests + responses
-from congestion import get_zone_congestion
+from congestion import apply_scan, get_zone_congestion
 from fastapi import FastAPI, HTTPException
 # fastapi.responses lets us return file-like-data
-from fastapi.responses import StreamingResponse
+# ORJSONResponse writes the response body with orjson instead of the stdlib json
+# (without a response_model FastAPI still runs jsonable_encoder on the dict first)
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from storage import create_surge_id
 from qr import generate_qr_code
-from datetime import datetime
+from config import SURGE_ID_TTL, VALID_ZONES
+from datetime import datetime, timezone
+import time
 # redis is a temporary system memory
-# that we will use to store the Active SURGE_IDS and Scan Event Lists
+# that we will use to store the Active SURGE_IDS, each one's current zone
+# and the per-zone congestion aggregates
 import redis
-import json
 from pydantic import BaseModel
 import os
 from dotenv import load_dotenv
@@ -23,7 +27,7 @@ class ScanRequest(BaseModel):
     zone: str
 
 
-app = FastAPI(title="SURGE")
+app = FastAPI(title="SURGE", default_response_class=ORJSONResponse)
 
 REDIS_HOST = os.getenv("REDIS_HOST")
 REDIS_PORT = os.getenv("REDIS_PORT")
@@ -36,15 +40,6 @@ r = redis.Redis(
     socket_timeout=2
 )
 
-VALID_ZONES = {
-    "terminal_entry",
-    "security",
-    "customs",
-    "boarding_gate",
-    "transfer",
-    "amenities"
-}
-
 
 @app.get("/issue")
 # issuing a new surge id and returning its qr code
@@ -55,7 +50,7 @@ def issue_surge_id():
     r.set(
         f"surge:{surge.id}",
         "active",
-        ex=3600
+        ex=SURGE_ID_TTL
     )
 
     qr_buffer = generate_qr_code(str(surge.id))
@@ -72,51 +67,36 @@ def scanqrcode(data: ScanRequest):
     surge_id = data.surge_id
     zone = data.zone
 
-    # first we need to check if the surgeid even exists
-    if not r.exists(f"surge:{surge_id}"):
-        raise HTTPException(
-            status_code=404, detail="Invalid or expired SURGE ID")
-
-    # second validate the zone
+    # validate the zone before touching Redis
     if zone not in VALID_ZONES:
         raise HTTPException(status_code=400, detail="Invalid Zone")
 
-    # Check current zone
-    scans_key = f"surge:{surge_id}:scans"
-    raw_scans = r.lrange(scans_key, 0, -1)
-
-    if raw_scans:
-        try:
-            current_scan = json.loads(raw_scans[-1])
-            if current_scan.get("zone") == zone:
-                # Already in this zone
-                return {
-                    "status": "already_scanned",
-                    "message": "You've already scanned in this zone",
-                    "surge_id": surge_id,
-                    "zone": zone,
-                    "current_timestamp": current_scan.get("timestamp")
-                }
-        except json.JSONDecodeError:
-            pass
-
-    # Delete all previous scans (removes from previous zones)
-    r.delete(scans_key)
-
-    # Record new scan in the new zone
-    timestamp = datetime.utcnow().isoformat()
-    scan_event = {
-        "zone": zone,
-        "timestamp": timestamp
-    }
+    # the id check, zone comparison and zone aggregate updates all happen in
+    # one atomic script, timestamped in epoch seconds
+    ts = time.time()
+    status, entered_at = apply_scan(r, surge_id, zone, ts)
+
+    # the surgeid doesn't exist or has expired
+    if status == "missing":
+        raise HTTPException(
+            status_code=404, detail="Invalid or expired SURGE ID")
 
-    r.rpush(scans_key, json.dumps(scan_event))
+    if status == "already_scanned":
+        # Already in this zone, timestamps are stored as epoch seconds
+        # and only turned into UTC datetimes for the response
+        return {
+            "status": "already_scanned",
+            "message": "You've already scanned in this zone",
+            "surge_id": surge_id,
+            "zone": zone,
+            "current_timestamp": datetime.fromtimestamp(entered_at, timezone.utc) if entered_at is not None else None
+        }
 
     return {
         "status": "scan recorded",
         "surge_id": surge_id,
         "zone": zone,
-        "timestamp": timestamp
+        "timestamp": datetime.fromtimestamp(ts, timezone.utc)
     }
 
 
@@ -1,7 +1,7 @@
 
-from dataclasses import dataclass
-# A dataclass is a python feature that helps you create simple "data holder" classes without writing a ton of boilerplate
-# @dataclass generated the __init__ for you automatically
+from typing import NamedTuple
+# A NamedTuple is a tuple with named fields, it's immutable and
+# doesn't carry a per-instance __dict__ so each record stays small
 from datetime import datetime
 from uuid import UUID
 
@@ -11,8 +11,7 @@ from uuid import UUID
 # id, time created, expiry time
 
 
-@dataclass
-class SurgeID:
+class SurgeID(NamedTuple):
     id: UUID  # MAKES THE UNIQUE UNIVERSAL IDENTIFIER
     created_at: datetime
     expires_at: datetime
@@ -1,36 +1,25 @@
 ##  QR Generation Logic ###
 
-# the qr generation library
-import qrcode
+# the qr generation library, it writes PNGs itself so no PIL needed
+import segno
 
 # bytes is an in-memory file
 from io import BytesIO
 
-from config import QR_IMG_SIZE
-
 
 # create a function to generate the qr code
 
 def generate_qr_code(surge_id: str):
     url = f"http://localhost:8000/passenger?sid={surge_id}"
 
-    # build the structure of the qr code
-    qr = qrcode.QRCode(
-        version=1,
-        box_size=10,
-        border=4,
-    )
-
-    # encodes the url
-    qr.add_data(url)
-    # calculates the layout of the qr
-    qr.make(fit=True)
-
-    img = qr.make_image(fill_color="black", back_color="white")
+    # encodes the url and picks the smallest version that fits
+    # boost_error=False keeps the error level at M like the old qrcode output,
+    # segno would otherwise raise it whenever the version has room
+    qr = segno.make(url, error="m", micro=False, boost_error=False)
 
     ## THIS IS WRITING THE IMAGE INTO MEMORY
     buffer = BytesIO()
-    img.save(buffer, format="PNG")
+    qr.save(buffer, kind="png", scale=10, border=4)
     ## resets the point to the start so FastAPI doesn't read it from the end
     buffer.seek(0)
 